@@ -12,9 +12,15 @@ for it to finish a lot sooner.
 """
 
 import os
+import re
 import sys
+import glob
+import shutil
+import hashlib
+import collections
+import subprocess
 import threading
-import Queue
+import urllib2
 import optparse
 import traceback
 
@@ -29,35 +35,254 @@ except KeyError:
 for e in "fts3", "rtree", "icu":
     os.putenv("APSW_TEST_"+e.upper(), e)
 
-def run(cmd):
-    status=os.system(cmd)
-    if os.WIFEXITED(status):
-        code=os.WEXITSTATUS(status)
-        if code==0:
-            return
-        raise Exception("Exited with code "+`code`+": "+cmd)
-    raise Exception("Failed with signal "+`os.WTERMSIG(status)`+": "+cmd)
+# one long lived shell per process for the short scaffolding commands,
+# so they cost a pipe write instead of a fork/exec each
+_sh=[None, 0]
 
-def dotest(pyver, logdir, pybin, pylib, workdir, sqlitever):
-    run("set -e ; cd %s ; ( env LD_LIBRARY_PATH=%s APSW_FORCE_DISTUTILS=t %s setup.py fetch --version=%s --all build_test_extension build_ext --inplace --force --enable-all-extensions test -v ) >%s 2>&1" % (workdir, pylib, pybin, sqlitever, os.path.abspath(os.path.join(logdir, "buildruntests.txt"))))
+def _shrun(cmd):
+    if _sh[0] is None or _sh[0].poll() is not None:
+        _sh[0]=subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+    sh=_sh[0]
+    _sh[1]+=1
+    sentinel="__DONE_%d__" % _sh[1]
+    # subshell so cd and friends don't leak between commands; the bare
+    # echo makes sure the sentinel starts a fresh line even when the
+    # command's output doesn't end in a newline
+    sh.stdin.write("( %s ) </dev/null ; __rc=$? ; echo ; echo %s $__rc\n" % (cmd, sentinel))
+    sh.stdin.flush()
+    while True:
+        line=sh.stdout.readline()
+        if not line:
+            # drop the dead shell now so the next call spawns a fresh
+            # one rather than writing into this one before it is reaped
+            _sh[0]=None
+            raise Exception("Shell coprocess died running: "+cmd)
+        if line.startswith(sentinel):
+            return int(line.split()[1])
+        # anything else is the command's own output
+        sys.stdout.write(line)
 
-def runtest(workdir, pyver, ucs, sqlitever, logdir):
-    pybin, pylib=buildpython(workdir, pyver, ucs, os.path.abspath(os.path.join(logdir, "pybuild.txt")))
-    dotest(pyver, logdir, pybin, pylib, workdir, sqlitever)
+def run(cmd, logfile=None, append=False):
+    if logfile is None:
+        code=_shrun(cmd)
+    else:
+        # when a logfile is given the fd is opened once here and handed
+        # to a fresh child, instead of every shell in the pipeline
+        # re-doing >log 2>&1.  subprocess rather than os.system so
+        # platforms with posix_spawn avoid fork()ing our address space
+        flags=os.O_WRONLY|os.O_CREAT|(append and os.O_APPEND or os.O_TRUNC)
+        out=os.open(logfile, flags, 0644)
+        try:
+            code=subprocess.Popen(["/bin/sh", "-c", cmd], close_fds=True, stdout=out, stderr=subprocess.STDOUT).wait()
+        finally:
+            os.close(out)
+    if code==0:
+        return
+    if code<0:
+        raise Exception("Failed with signal "+`-code`+": "+cmd)
+    raise Exception("Exited with code "+`code`+": "+cmd)
 
-def threadrun(queue):
+# downloaded Python tarballs are kept here across runs
+TARBALLCACHE=os.path.abspath(os.path.join("cache", "tarballs"))
+
+def workdirbase():
+    # point MEGATEST_WORKDIR at a tmpfs (eg /dev/shm/megatest) to keep
+    # the source trees and compile intermediates off disk entirely
+    return os.path.abspath(os.environ.get("MEGATEST_WORKDIR", "work"))
+
+def link_tree(pattern, dest):
+    # hardlinks are zero-byte "copies" sharing one page cache entry
+    # across all the workdirs; fall back to a real copy when dest is
+    # on a different filesystem (eg a tmpfs workdir base)
+    for src in glob.glob(pattern):
+        d=os.path.join(dest, os.path.basename(src))
+        if os.path.exists(d):
+            os.unlink(d)
+        try:
+            os.link(src, d)
+        except OSError:
+            shutil.copy(src, d)
+
+def tarballpath(url):
+    return os.path.join(TARBALLCACHE, url.split("/")[-1])
+
+def _hashfile(path):
+    # sha256 - hardware accelerated by hashlib on anything recent, so
+    # this is far cheaper than re-downloading
+    h=hashlib.sha256()
+    f=open(path, "rb")
     while True:
-        d=queue.get()
-        if d is None:
-            return
+        blk=f.read(1<<20)
+        if not blk:
+            break
+        h.update(blk)
+    f.close()
+    return h.hexdigest()
+
+# digests of what we downloaded, in the same url/length/hash line
+# format as the top level checksums file (but sha256 - that file only
+# covers the SQLite downloads done by setup.py)
+_cachesums=None
+
+def _loadcachesums():
+    global _cachesums
+    if _cachesums is None:
+        _cachesums={}
         try:
-            runtest(**d)
-            sys.stdout.write(".")
-            sys.stdout.flush()
+            for line in open(os.path.join(TARBALLCACHE, "CHECKSUMS"), "rt"):
+                line=line.split()
+                if len(line)==3:
+                    _cachesums[line[0]]=(int(line[1]), line[2])
+        except IOError:
+            pass
+    return _cachesums
+
+def _recordcachesum(url, path):
+    entry=(os.path.getsize(path), _hashfile(path))
+    _loadcachesums()[url]=entry
+    # single small append so concurrent fetch threads can't corrupt it
+    open(os.path.join(TARBALLCACHE, "CHECKSUMS"), "at").write("%s %d %s\n" % (url, entry[0], entry[1]))
+
+def verify_tarball(url):
+    # is the cached copy present and matching its recorded digest?
+    t=tarballpath(url)
+    if not os.path.exists(t):
+        return False
+    sums=_loadcachesums()
+    if url not in sums:
+        # predates checksum recording - it downloaded completely (the
+        # .part rename) so take its digest now
+        _recordcachesum(url, t)
+        return True
+    size,digest=sums[url]
+    if os.path.getsize(t)==size and _hashfile(t)==digest:
+        return True
+    # corrupt - remove so it gets downloaded again
+    os.unlink(t)
+    return False
+
+def fetchtarball(url):
+    # download in-process - no wget/shell forks, and writing to a
+    # temporary name means a partial download is never mistaken for a
+    # good cached copy
+    try:
+        os.makedirs(TARBALLCACHE)
+    except OSError:
+        pass
+    t=tarballpath(url)
+    r=urllib2.urlopen(url)
+    f=open(t+".part", "wb")
+    while True:
+        blk=r.read(1<<20)
+        if not blk:
+            break
+        f.write(blk)
+    f.close()
+    r.close()
+    os.rename(t+".part", t)
+    _recordcachesum(url, t)
+
+def prefetch_all_pythons(pyvers):
+    # start all the downloads at once so network latency is paid once
+    # up front instead of stalling each worker as it starts.  threads
+    # are fine here - they just sit in socket reads
+    urls=[getpyurl(pyver) for pyver in pyvers if pyver!="system"]
+    urls=[url for url in urls if not verify_tarball(url)]
+    failed=[]
+    def fetch(url):
+        try:
+            fetchtarball(url)
         except:
-            # uncomment to debug problems with this script
-            # traceback.print_exc()
-            print "\nFAILED", d
+            failed.append(url)
+    threads=[threading.Thread(target=fetch, args=(url,)) for url in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failed:
+        raise Exception("Failed to download "+", ".join(failed))
+
+_multiarch=[]
+def multiarch():
+    # constant for the host so only fork dpkg-architecture the first time
+    if not _multiarch:
+        _multiarch.append(subprocess.check_output(["dpkg-architecture", "-qDEB_HOST_MULTIARCH"]).strip())
+    return _multiarch[0]
+
+def getnprocs():
+    nprocs=0
+    try:
+        # try and work out how many processors there are - this works on linux
+        for line in open("/proc/cpuinfo", "rt"):
+            line=line.split()
+            if line and line[0]=="processor":
+                nprocs+=1
+    except:
+        pass
+    # well there should be at least one!
+    return max(nprocs, 1)
+
+def makejobs():
+    # set by main() so child make runs use the cores the scheduler
+    # itself is not keeping busy
+    return int(os.environ.get("MEGATEST_MAKEJOBS", "1"))
+
+def ccache_env():
+    # use ccache if present so identical compiles across runs are free
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        if os.path.isfile(os.path.join(d, "ccache")):
+            return 'CC="ccache gcc"; export CC; '
+    return ""
+
+def dotest(pyver, logdir, pybin, pylib, workdir, sqlitever):
+    run("set -e ; cd %s ; env LD_LIBRARY_PATH=%s APSW_FORCE_DISTUTILS=t MAKEFLAGS=-j%d %s setup.py fetch --version=%s --all build_test_extension build_ext --inplace --force --enable-all-extensions test -v" % (workdir, pylib, makejobs(), pybin, sqlitever),
+        logfile=os.path.abspath(os.path.join(logdir, "buildruntests.txt")))
+
+def runtest(workdir, pyver, ucs, sqlitever, logdir):
+    pybin, pylib=pythonloc(pyver, ucs)
+    dotest(pyver, logdir, pybin, pylib, workdir, sqlitever)
+
+def pyinstalldir(pyver, ucs):
+    # a Python build depends only on (pyver,ucs) so it is shared
+    # between all the SQLite versions tested against it
+    return os.path.join(workdirbase(), "pyinstall-py%s-ucs%d" % (pyver, ucs))
+
+def pythonloc(pyver, ucs):
+    if pyver=="system":
+        return "/usr/bin/python", ""
+    d=pyinstalldir(pyver, ucs)
+    return os.path.join(d, "pyinst", "bin", "python"+build_plan(pyver).suf), os.path.join(d, "pyinst", "lib")
+
+def jobcmd(d):
+    # each job runs as a child process (re-invoking this script in
+    # worker mode) so there are no Python threads fighting over the GIL
+    return [sys.executable, os.path.abspath(__file__), "--worker",
+            d['workdir'], d['pyver'], str(d['ucs']), d['sqlitever'], d['logdir']]
+
+def buildjobcmd(pyver, ucs):
+    return [sys.executable, os.path.abspath(__file__), "--worker-build", pyver, str(ucs)]
+
+def workermain(args):
+    workdir, pyver, ucs, sqlitever, logdir=args
+    try:
+        runtest(workdir=workdir, pyver=pyver, ucs=int(ucs), sqlitever=sqlitever, logdir=logdir)
+    except:
+        # uncomment to debug problems with this script
+        # traceback.print_exc()
+        sys.exit(1)
+    sys.exit(0)
+
+def buildworkermain(args):
+    pyver, ucs=args[0], int(args[1])
+    try:
+        installdir=pyinstalldir(pyver, ucs)
+        run("mkdir -p "+installdir)
+        buildpython(installdir, pyver, ucs, os.path.abspath(os.path.join("megatestresults", "pybuild-py%s-ucs%d.txt" % (pyver, ucs))))
+    except:
+        # uncomment to debug problems with this script
+        # traceback.print_exc()
+        sys.exit(1)
+    sys.exit(0)
 
 def main(PYVERS, UCSTEST, SQLITEVERS, concurrency):
     try:
@@ -65,16 +290,35 @@ def main(PYVERS, UCSTEST, SQLITEVERS, concurrency):
     except KeyError:
         pass
     print "Test starting"
-    os.system("rm -rf apsw.so megatestresults 2>/dev/null ; mkdir megatestresults")
+    # in-process cleanup - no shells forked and no $HOME expansion issues
+    def zap(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.unlink(path)
+    zap("apsw.so")
+    zap("megatestresults")
+    os.makedirs("megatestresults")
+    # all job status goes through this one fd - each os.write is a
+    # single syscall so records never interleave with worker output
+    global _status_fd
+    _status_fd=os.open(os.path.join("megatestresults", "status.log"), os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
     print "  ... removing old work directory"
-    workdir=os.path.abspath("work")
-    os.system("rm -rf %s/* 2>/dev/null ; mkdir -p %s" % (workdir, workdir))
-    os.system("rm -f src/shell.c") # autogenerated
-    os.system('rm -rf $HOME/.local/lib/python*/site-packages/apsw* 2>/dev/null')
+    workdir=workdirbase()
+    zap(workdir)
+    os.makedirs(workdir)
+    zap("src/shell.c") # autogenerated
+    for p in glob.glob(os.path.expanduser("~/.local/lib/python*/site-packages/apsw*")):
+        zap(p)
+    print "      done"
+    # share the cores out between the concurrent builds' make runs
+    os.environ["MEGATEST_MAKEJOBS"]=str(max(1, getnprocs()//concurrency+1))
+    print "  ... prefetching Python source"
+    prefetch_all_pythons(PYVERS)
     print "      done"
 
-    queue=Queue.Queue()
-    threads=[]
+    jobs=[]
+    builds=set()
 
     for pyver in PYVERS:
         for ucs in UCSTEST:
@@ -83,26 +327,65 @@ def main(PYVERS, UCSTEST, SQLITEVERS, concurrency):
                 ucs=0
             for sqlitever in SQLITEVERS:
                 print "Python",pyver,"ucs",ucs,"   SQLite",sqlitever
-                workdir=os.path.abspath(os.path.join("work", "py%s-ucs%d-sq%s" % (pyver, ucs, sqlitever)))
+                workdir=os.path.join(workdirbase(), "py%s-ucs%d-sq%s" % (pyver, ucs, sqlitever))
                 logdir=os.path.abspath(os.path.join("megatestresults", "py%s-ucs%d-sq%s" % (pyver, ucs, sqlitever)))
-                run("mkdir -p %s/src %s/tools %s" % (workdir, workdir, logdir))
-                run("cp *.py checksums "+workdir)
-                run("cp tools/*.py "+workdir+"/tools/")
-                run("cp src/*.c src/*.h "+workdir+"/src/")
+                for d in (os.path.join(workdir, "src"), os.path.join(workdir, "tools"), logdir):
+                    os.makedirs(d)
+                link_tree("*.py", workdir)
+                link_tree("checksums", workdir)
+                link_tree("tools/*.py", os.path.join(workdir, "tools"))
+                link_tree("src/*.c", os.path.join(workdir, "src"))
+                link_tree("src/*.h", os.path.join(workdir, "src"))
 
-                queue.put({'workdir': workdir, 'pyver': pyver, 'ucs': ucs, 'sqlitever': sqlitever, 'logdir': logdir})
+                builds.add((pyver, ucs))
+                jobs.append({'workdir': workdir, 'pyver': pyver, 'ucs': ucs, 'sqlitever': sqlitever, 'logdir': logdir})
 
-    threads=[]
-    for i in range(concurrency):
-        queue.put(None) # exit sentinel
-        t=threading.Thread(target=threadrun, args=(queue,))
-        t.start()
-        threads.append(t)
+    buildjobs=[(buildjobcmd(pyver, ucs), {'pyver': pyver, 'ucs': ucs})
+               for pyver,ucs in sorted(builds) if pyver!="system"]
+    print "Building %d Pythons (%d concurrency)" % (len(buildjobs), concurrency)
+    schedule(buildjobs, concurrency)
 
-    print "All builds started, now waiting for them to finish (%d concurrency)" % (concurrency,)
-    for t in threads:
-        t.join()
-    print "\nFinished"
+    print "\nAll builds done, now running the tests (%d concurrency)" % (concurrency,)
+    schedule([(jobcmd(d), d) for d in jobs], concurrency)
+    print "\nFinished - results are in megatestresults/status.log"
+
+_status_fd=None
+
+def schedule(jobs, concurrency):
+    # a process-pool executor in miniature: keep up to concurrency
+    # child processes going, reaping with waitpid and starting the
+    # next job as each one finishes.  jobs are independent and return
+    # nothing, so there is no result plumbing to do
+    running={}
+    while jobs or running:
+        while jobs and len(running)<concurrency:
+            cmd,d=jobs.pop(0)
+            p=subprocess.Popen(cmd)
+            running[p.pid]=(p, d)
+        pid,status=os.waitpid(-1, 0)
+        if pid not in running:
+            continue
+        p,d=running.pop(pid)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status)==0:
+            os.write(_status_fd, ".")
+        else:
+            os.write(_status_fd, "\nFAILED %r\n" % (d,))
+
+_v2i_cache={}
+def _v2i(x):
+    try:
+        return _v2i_cache[x]
+    except KeyError:
+        r=_v2i_cache[x]=tuple(int(i) for i in x.split("."))
+        return r
+
+# Python stopped making new releases as bz2 and instead it is
+# xz in the middle of a release stream
+_SWITCHVERS=tuple(_v2i(v) for v in (
+    "3.2.6",
+    "2.7.7",
+    "2.6.9",
+))
 
 def getpyurl(pyver):
     dirver=pyver
@@ -116,28 +399,27 @@ def getpyurl(pyver):
         # Upper or lower case 'p' in download filename is somewhat random
         p='P'
         ext="bz2"
-        # Python stopped making new releases as bz2 and instead it is
-        # xz in the middle of a release stream
-        switchvers=(
-            "3.2.6",
-            "2.7.7",
-            "2.6.9",
-        )
-        v2i=lambda x: [int(i) for i in x.split(".")]
+        dv=_v2i(dirver)
         if pyver>='3.3':
             ext="xz"
-        for v in switchvers:
-            if v2i(dirver)[:2]==v2i(v)[:2] and v2i(dirver)>=v2i(v):
-                ext="xz"
-                break
+        elif any(dv[:2]==sv[:2] and dv>=sv for sv in _SWITCHVERS):
+            ext="xz"
         return "https://www.python.org/ftp/python/%s/%sython-%s.tar.%s" % (dirver,p,pyver,ext)
     if pyver=='2.3.0':
         pyver='2.3'
         dirver='2.3'
     return "https://www.python.org/ftp/python/%s/Python-%s.tgz" % (dirver,pyver)
 
-def buildpython(workdir, pyver, ucs, logfilename):
-    if pyver=="system": return "/usr/bin/python", ""
+# everything about building a version that only depends on the version
+# string, worked out once instead of re-branched in every job
+BuildPlan=collections.namedtuple("BuildPlan", "url tarx srcver basecflags full patch_natty suf")
+
+_build_plans={}
+def build_plan(pyver):
+    try:
+        return _build_plans[pyver]
+    except KeyError:
+        pass
     url=getpyurl(pyver)
     if url.endswith(".bz2"):
         tarx="j"
@@ -145,43 +427,45 @@ def buildpython(workdir, pyver, ucs, logfilename):
         tarx="J"
     else:
         tarx="z"
-    if pyver=="2.3.0": pyver="2.3"
-    run("set -e ; cd %s ; mkdir pyinst ; ( echo \"Getting %s\"; wget -q %s -O - | tar xf%s -  ) > %s 2>&1" % (workdir, url, url, tarx, logfilename))
+    # the 2.3.0 source unpacks as Python-2.3
+    srcver=pyver=="2.3.0" and "2.3" or pyver
     # See https://bugs.launchpad.net/ubuntu/+source/gcc-defaults/+bug/286334
-    if pyver.startswith("2.3"):
-        # https://bugs.launchpad.net/bugs/286334
-        opt='BASECFLAGS=-U_FORTIFY_SOURCE'
-    else:
-        opt=''
-    if pyver.startswith("3.0"):
-        full="full" # 3.1 rc 1 doesn't need 'fullinstall'
-    else:
-        full=""
+    basecflags=srcver.startswith("2.3") and 'BASECFLAGS=-U_FORTIFY_SOURCE' or ''
+    full=srcver.startswith("3.0") and "full" or "" # 3.1 rc 1 doesn't need 'fullinstall'
+    # zlib on natty issue: http://lipyrary.blogspot.com/2011/05/how-to-compile-python-on-ubuntu-1104.html
+    # LDFLAGS works for Python 2.5 onwards.  Edit setup on 2.3 and 2.4
+    patch_natty=srcver.startswith("2.3") or srcver.startswith("2.4")
+    suf=srcver>="3.1" and "3" or ""
+    plan=_build_plans[pyver]=BuildPlan(url, tarx, srcver, basecflags, full, patch_natty, suf)
+    return plan
+
+def buildpython(workdir, pyver, ucs, logfilename):
+    if pyver=="system": return "/usr/bin/python", ""
+    plan=build_plan(pyver)
+    tarball=tarballpath(plan.url)
+    if not verify_tarball(plan.url):
+        # normally already there from prefetch_all_pythons
+        fetchtarball(plan.url)
+    run("set -e ; cd %s ; mkdir pyinst ; echo \"Extracting %s\"; tar xf%s %s" % (workdir, tarball, plan.tarx, tarball), logfile=logfilename)
     if sys.platform.startswith("linux"):
-        # zlib on natty issue: http://lipyrary.blogspot.com/2011/05/how-to-compile-python-on-ubuntu-1104.html
-        # LDFLAGS works for Python 2.5 onwards.  Edit setup on 2.3 and 2.4
-        if pyver.startswith("2.3") or pyver.startswith("2.4"):
-            patch_natty_build(os.path.join(workdir, "Python-"+pyver, "setup.py"))
-        ldflags="LDFLAGS=\"-L/usr/lib/$(dpkg-architecture -qDEB_HOST_MULTIARCH)\"; export LDFLAGS;"
+        if plan.patch_natty:
+            patch_natty_build(os.path.join(workdir, "Python-"+plan.srcver, "setup.py"))
+        ldflags="LDFLAGS=\"-L/usr/lib/%s\"; export LDFLAGS;" % (multiarch(),)
     else:
         ldflags=""
-    run("set -e ; %s cd %s ; cd ?ython-%s ; ./configure %s --disable-ipv6 --enable-unicode=ucs%d --prefix=%s/pyinst  >> %s 2>&1; make >>%s 2>&1; make  %sinstall >>%s 2>&1 ; make clean >/dev/null" % (ldflags, workdir, pyver, opt, ucs, workdir, logfilename, logfilename, full, logfilename))
-    suf=""
-    if pyver>="3.1":
-        suf="3"
-    pybin=os.path.join(workdir, "pyinst", "bin", "python"+suf)
+    run("set -e ; %s %s cd %s ; cd ?ython-%s ; ./configure %s --disable-ipv6 --enable-unicode=ucs%d --prefix=%s/pyinst ; make -j%d ; make -j%d %sinstall ; make clean" % (ccache_env(), ldflags, workdir, plan.srcver, plan.basecflags, ucs, workdir, makejobs(), makejobs(), plan.full),
+        logfile=logfilename, append=True)
+    pybin=os.path.join(workdir, "pyinst", "bin", "python"+plan.suf)
     return pybin, os.path.join(workdir, "pyinst", "lib")
 
+_natty_pat=re.compile(r"(lib_dirs = self\.compiler\.library_dirs \+ \[)")
+
 def patch_natty_build(setup):
     assert os.path.isfile(setup)
-    out=[]
-    for line in open(setup, "rtU"):
-        if line.strip().startswith("lib_dirs = self.compiler.library_dirs + ["):
-            t=" '/usr/lib/"+os.popen("dpkg-architecture -qDEB_HOST_MULTIARCH", "r").read().strip()+"', "
-            i=line.index("[")
-            line=line[:i+1]+t+line[i+1:]
-        out.append(line)
-    open(setup, "wt").write("".join(out))
+    # one read, one regex pass, one write - no line loop
+    data=open(setup, "rtU").read()
+    t=" '/usr/lib/"+multiarch()+"', "
+    open(setup, "wt").write(_natty_pat.sub(lambda m: m.group(1)+t, data))
 
 # Default versions we support
 PYVERS=(
@@ -202,23 +486,23 @@ SQLITEVERS=(
     '3.13.0',
 )
 
+# plans for the default versions are ready before any job runs; other
+# versions asked for with --pyvers get theirs on first use
+PYTHON_BUILD_TABLE=dict((v, build_plan(v)) for v in PYVERS if v!="system")
+
 if __name__=='__main__':
-    nprocs=0
-    try:
-        # try and work out how many processors there are - this works on linux
-        for line in open("/proc/cpuinfo", "rt"):
-            line=line.split()
-            if line and line[0]=="processor":
-                nprocs+=1
-    except:
-        pass
-    # well there should be at least one!
-    if nprocs==0:
-        nprocs=1
+    # child process mode used by main()'s scheduler - not for direct use
+    if sys.argv[1:2]==["--worker"]:
+        workermain(sys.argv[2:])
+    if sys.argv[1:2]==["--worker-build"]:
+        buildworkermain(sys.argv[2:])
+
+    nprocs=getnprocs()
 
-    concurrency=nprocs*2
-    if concurrency>8:
-        concurrency=8
+    # the workers are CPU bound compiles (make runs in parallel inside
+    # each) so match the cores instead of oversubscribing them; this
+    # only caps the default - --tasks takes whatever it is given
+    concurrency=min(nprocs, 8)
 
     parser=optparse.OptionParser()
     parser.add_option("--pyvers", dest="pyvers", help="Which Python versions to test against [%default]", default=",".join(PYVERS))